@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
-import argparse, json, re, sys
+import argparse, json, os, sys
 from pathlib import Path
 import cutie
-import xml.etree.cElementTree as ET
+from xml.sax.saxutils import escape
 import traceback
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Built from dir_info_with_files_trimmed.json from https://github.com/CSharpM7/reslotter
 ALLOWED_EXTENSIONS = {
@@ -12,14 +16,21 @@ ALLOWED_EXTENSIONS = {
     ".nus3audio", ".nus3bank", ".nusktb", ".nusrcmdlb", ".nutexb", ".prc",
     ".shpc", ".shpcanim", ".sqb", ".stdat", ".stprm", ".tonelabel", ".xmb"
 }
+ALLOWED_SUFFIXES = tuple(ALLOWED_EXTENSIONS)
 SOUND_EXTS = [".nus3audio", ".nus3bank", ".tonelabel"]
 # Built from CSK Alt Generator source code
 UI_NAMES = {'battlefield_l': 'BattleFieldL', 'battlefield_s': 'BattleFieldS'}
 UI_IS_PATCH = {'brave_altar', 'jack_mementoes', 'sp_edit', 'demon_dojo', 'ff_cave', 'buddy_spiral', 'pickel_world', 'dolly_stadium', 'xeno_alst', 'battlefield_s', 'homeruncontest', 'trail_castle', 'fe_shrine', 'tantan_spring'}
 STAGE_NO_BATTLE = {"battlefield_l", "battlefield_s", "battlefield", "end"}
-
-
-def is_allowed(p): return Path(p).suffix.lower() in ALLOWED_EXTENSIONS
+# Same output ElementTree gave us (including its platform newlines), without building a tree for one entry
+XMSBT_TEMPLATE = (
+    "<?xml version='1.0' encoding='utf-16'?>\n"
+    "<xmsbt>\n"
+    '  <entry label="{label}">\n'
+    "    <text>{text}</text>\n"
+    "  </entry>\n"
+    "</xmsbt>"
+).replace("\n", os.linesep)
 
 
 '''
@@ -38,37 +49,65 @@ def find_single_stage_dir(root: Path):
     return stage_dir, subs[0].name
 
 
-def substitute_stage_name(path_in_current: str, current_stage: str, base_stage: str):
-    parts = path_in_current.replace("\\","/").split("/")
-    if len(parts) >= 3 and parts[0] == "stage" and parts[1] == current_stage:
-        parts[1] = base_stage
-        return "/".join(parts)
-    return "/".join(parts)
+# Prefixes are "stage/{name}/", built once by the caller. Paths are already "/" separated by collect_all_allowed
+def substitute_stage_name(path_in_current: str, current_prefix: str, base_prefix: str):
+    if path_in_current.startswith(current_prefix):
+        return base_prefix + path_in_current[len(current_prefix):]
+    return path_in_current
 
 
-# Collects all files from file_array that is part of the stage we're redirecting
-def build_base_stage_files(file_array, base_stage: str):
-    pref_b = f"stage/{base_stage}/battle/"
-    pref_n = f"stage/{base_stage}/normal/"
-    out = []
+# Buckets every stage file in file_array by (stage, subfolder) in a single pass
+def build_stage_index(file_array):
+    index = {}
     for p in file_array:
-        if p.startswith(pref_b) or p.startswith(pref_n):
-            out.append(p)
-    return out
+        if not p.startswith("stage/"): continue
+        parts = p.split("/", 3)
+        if len(parts) == 4:
+            index.setdefault((parts[1], parts[2]), []).append(p)
+    return index
+
+
+# Collects all files from file_array that is part of the stage we're redirecting
+def build_base_stage_files(stage_index: dict, base_stage: str):
+    return stage_index.get((base_stage, "battle"), []) + stage_index.get((base_stage, "normal"), [])
+
+
+# Walks the folder with os.scandir, reusing each DirEntry's cached type info instead of a stat per file
+def _scan(dirpath: str, root_len: int):
+    with os.scandir(dirpath) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _scan(e.path, root_len)
+            elif e.is_file(follow_symlinks=False):
+                yield e.path[root_len:]
 
 
 # Only gathers files that have extensions that are in the base game. Prevents things like .prcxml from being edited.
 def collect_all_allowed(root: Path):
-    m_files = []
-    for p in root.rglob("*"):
-        if p.is_file():
-            rel = str(p.relative_to(root)).replace("\\", "/")
-            if is_allowed(rel): m_files.append(rel)
+    root_str = str(root)
+    m_files = {rel for rel in _scan(root_str, len(os.path.join(root_str, ""))) if rel.lower().endswith(ALLOWED_SUFFIXES)}
+    # Only Windows paths need their separators normalized, and only for files that were kept
+    if os.sep == "\\": m_files = {rel.replace("\\", "/") for rel in m_files}
     return m_files
 
 
-def in_base_dirs(cp, base_file_set):
-    return any(p == cp or p.startswith(cp + "/") for p in base_file_set)
+# Every directory that holds a base game file, so checking a dir against the base game is a set lookup
+def build_base_dir_set(file_array):
+    res = set()
+    for p in file_array:
+        parts = p.split("/")
+        for i in range(1, len(parts)):
+            res.add("/".join(parts[:i]))
+    return res
+
+
+def write_json(path: Path, data):
+    with open(path, "wb", buffering=1 << 20) as f:
+        if orjson is not None:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        else:
+            # json.dumps goes through the C encoder, json.dump always uses the pure Python one
+            f.write(json.dumps(data, separators=(",", ":")).encode("utf-8"))
 
 
 def write_config(root: Path, share_to_vanilla: dict, new_dir_files: dict, new_dir_infos: list):
@@ -77,61 +116,60 @@ def write_config(root: Path, share_to_vanilla: dict, new_dir_files: dict, new_di
     data["share_to_vanilla"] = share_to_vanilla
     data["new-dir-files"] = new_dir_files
     data["new-dir-infos"] = new_dir_infos
-    with open(cfg_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    write_json(cfg_path, data)
 
 
 def sound_paths_for(stage_name: str):
-    return [f"sound/bank/stage/se_stage_{stage_name}{ext}" for ext in SOUND_EXTS]
+    return tuple(f"sound/bank/stage/se_stage_{stage_name}{ext}" for ext in SOUND_EXTS)
 
 
 def ui_paths_for(stage_name: str):
-    ui_paths = []
     ui_replace = "replace_patch" if stage_name in UI_IS_PATCH else "replace"
     stage_ui = UI_NAMES.get(stage_name, stage_name)
-    for i in range(5):
-        ui_paths.append(f"ui/{ui_replace}/stage/stage_{i}/stage_{i}_{stage_ui}.bntx")
-    return ui_paths
-
-def is_stage_sound_for(stage_name: str, path_str: str):
-    return bool(
-        re.fullmatch(rf"sound/bank/stage/se_stage_{re.escape(stage_name)}\.(nus3audio|nus3bank|tonelabel)", path_str))
+    return tuple(f"ui/{ui_replace}/stage/stage_{i}/stage_{i}_{stage_ui}.bntx" for i in range(5))
 
 def is_stage_eff_for(stage_name: str, path_str: str):
     return f"effect/stage/{stage_name}/ef_{stage_name}.eff" == path_str
 
 
-def add_dir_with_parents(d: str, base_file_set: set, new_dir_infos_set: set, new_dir_infos: list):
-    p = Path(d)
-    while True:
-        ds = str(p).replace("\\", "/")
-        if ds and ds != "." and ds not in new_dir_infos_set and not in_base_dirs(ds, base_file_set):
-            new_dir_infos.append(ds)
-            new_dir_infos_set.add(ds)
-        if not p.parts: break
-        p = p.parent
-        if str(p) == "" or str(p) == ".": break
+def add_dir_with_parents(d: str, base_dir_set: set, new_dir_infos_set: set, new_dir_infos: list):
+    while d:
+        if d not in new_dir_infos_set and d not in base_dir_set:
+            new_dir_infos.append(d)
+            new_dir_infos_set.add(d)
+        i = d.rfind("/")
+        if i < 0: break
+        d = d[:i]
+
+
+def add_dir_file(key: str, f: str, new_dir_files: dict, new_dir_files_sets: dict):
+    s = new_dir_files_sets.setdefault(key, set())
+    if f not in s:
+        s.add(f)
+        new_dir_files.setdefault(key, []).append(f)
 
 
 def build_base_dir_infos(tree_root, base_stage, current_stage):
     # Unlike fighters, stage dir infos are mostly identical to their actual file locations
     # This step is here as a precaution, just to ensure the stages are accurately replicated
-    res = set()
-    stage_node = (((tree_root or {}).get("directories") or {}).get("stage") or {}).get("directories") or {}
-    stage_branch = stage_node.get(base_stage)
-
-    def walk(node, prefix):
-        res.add(prefix)
-        dirs = node.get("directories") or {}
-        for name, sub in dirs.items(): walk(sub, f"{prefix}/{name}")
-
-    walk(stage_branch, f"stage/{current_stage}")
-    return sorted(res)
+    res = []
+    stage_branch = tree_root["directories"]["stage"]["directories"].get(base_stage)
+    if stage_branch is None:
+        raise Exception(f"{base_stage} is not a base game stage. Please ensure the stage name is spelled correctly.")
+
+    stack = [(stage_branch, f"stage/{current_stage}")]
+    while stack:
+        node, prefix = stack.pop()
+        res.append(prefix)
+        dirs = node.get("directories")
+        if dirs is not None:
+            for name, sub in dirs.items(): stack.append((sub, prefix + "/" + name))
+    return res
     
     
 def gather_base_stages(tree_root):
     # Simply gets the base game stages and saves to a set
-    stage_node = (((tree_root or {}).get("directories") or {}).get("stage") or {}).get("directories") or {}
+    stage_node = tree_root["directories"]["stage"]["directories"]
     res = {k.lower().strip() for k in stage_node.keys()}
     return sorted(res)
     
@@ -151,11 +189,17 @@ def find_valid_database_json(root: Path, current_stage: str):
     return None         
         
 
-def safe_rename(src: Path, dst: Path):
-    if not src.exists(): return False
+def safe_rename(src: Path, dst: Path, created_dirs: set):
+    # Never overwrite whatever is already at the destination
     if dst.exists(): return False
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    src.rename(dst)
+    try:
+        os.replace(src, dst)
+    except FileNotFoundError:
+        # Either src is missing or the destination folder doesn't exist yet
+        if dst.parent in created_dirs or not src.exists(): return False
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        created_dirs.add(dst.parent)
+        os.replace(src, dst)
     return True
 
 
@@ -168,10 +212,10 @@ def rename_stage(root: Path, old: str, new: str):
         changes.append((root / f"ui/replace/stage/stage_{i}/stage_{i}_{old}.bntx", root / f"ui/replace/stage/stage_{i}/stage_{i}_{new}.bntx"))
         changes.append((root / f"ui/replace_patch/stage/stage_{i}/stage_{i}_{old}.bntx", root / f"ui/replace_patch/stage/stage_{i}/stage_{i}_{new}.bntx"))
     changes.append((root / f"stage/{old}", root / f"stage/{new}"))
-    done = 0
+    done, created_dirs = 0, set()
     for src, dst in changes:
         try:
-            if safe_rename(src, dst): done += 1
+            if safe_rename(src, dst, created_dirs): done += 1
         except Exception as e: 
             print(f"WARNING: Failed to rename {src} to {dst}!\nFile must be manually renamed!")
     return done
@@ -198,41 +242,19 @@ def app_dir() -> Path:
         return Path(sys.executable).resolve().parent
     return Path(__file__).resolve().parent
 
-# Not my function but I can't remember where I found it
+# Bottom-up walk, so by the time a folder is reached all of its subfolders have already been tried
 def delete_empty_dirs(path):
-    # get a list of all directorys in path and subpaths
-    def get_dirs(path, result=[]):
-        for p in path.iterdir():
-            if p.is_dir():
-                result += [p]
-                get_dirs(p)
-        return result
-
-
-    # keep trying to delete empty folders until none are left
-    dirs = get_dirs(path)
-    done = False
-    while not done:
-        done = True
-        for p in dirs:
+    for dirpath, dirnames, _ in os.walk(path, topdown=False):
+        for d in dirnames:
             try:
-                p.rmdir()
-                done = False
+                os.rmdir(os.path.join(dirpath, d))
             except OSError:
                 pass
-                
-# Basically just pulled this from stackoverflow
+
 def create_stage_xmsbt(m_string: str, file_path: Path, stage_name: str):
-    root = ET.Element("xmsbt")
-    entry = ET.SubElement(root, "entry", label=f"nam_stg1_{stage_name}")
-    text_elem = ET.SubElement(entry, "text")
-    text_elem.text = m_string
-    tree = ET.ElementTree(root)
-    ET.indent(root, space="  ")
-    
+    xml = XMSBT_TEMPLATE.format(label=escape(f"nam_stg1_{stage_name}", {'"': "&quot;"}), text=escape(m_string))
     file_path.parent.mkdir(parents=True, exist_ok=True)
-    
-    tree.write(file_path, encoding="utf-16")
+    file_path.write_bytes(b"\xff\xfe" + xml.encode("utf-16-le"))
 
 
 def main():
@@ -246,8 +268,11 @@ def main():
     root = Path(args.root).resolve()
     stage_dir, detected_stage = find_single_stage_dir(root)
     
-    with open(args.base, "r", encoding="utf-8") as f:
-        base_data = json.load(f)
+    if orjson is not None:
+        base_data = orjson.loads(Path(args.base).read_bytes())
+    else:
+        with open(args.base, "r", encoding="utf-8") as f:
+            base_data = json.load(f)
     
     base_file_array = base_data.get("file_array")
     dirs_tree = base_data.get("dirs")
@@ -269,14 +294,18 @@ def main():
 
     # This shouldn't cause issues, all files are unique
     base_file_set = set(base_file_array)
-    base_stage_files = build_base_stage_files(base_file_array, base_stage)
+    base_dir_set = build_base_dir_set(base_file_array)
+    base_stage_files = build_base_stage_files(build_stage_index(base_file_array), base_stage)
+    base_sound_paths = sound_paths_for(base_stage)
+    base_ui_paths = ui_paths_for(base_stage)
 
+    current_prefix, base_prefix = f"stage/{current_stage}/", f"stage/{base_stage}/"
     if is_renamed:
         scanned_files = collect_all_allowed(root)
-        scanned_files_base = {substitute_stage_name(p, current_stage, base_stage) for p in scanned_files}
+        scanned_files_base = {substitute_stage_name(p, current_prefix, base_prefix) for p in scanned_files}
     else:
         scanned_files_base = collect_all_allowed(root)
-        scanned_files = {substitute_stage_name(p, base_stage, current_stage) for p in scanned_files_base}
+        scanned_files = {substitute_stage_name(p, base_prefix, current_prefix) for p in scanned_files_base}
 
 
     # These are the files we're going to share. Only saves the base_stage_files files that aren't on disk
@@ -284,40 +313,29 @@ def main():
 
     share_to_vanilla = {}
     new_files, new_files_set = [], set()
+    old_seg, new_seg = f"/{base_stage}/", f"/{current_stage}/"
     for share_file in to_share:
-        target = share_file.replace(f"/{base_stage}/", f"/{current_stage}/")
+        target = share_file.replace(old_seg, new_seg)
         share_to_vanilla[share_file] = target
         if target not in base_file_set and target not in new_files_set:
             new_files.append(target)
             new_files_set.add(target)
 
+    # Shares a vanilla file unless the mod already has it under either name
+    def try_share(src, target):
+        if src in scanned_files or target in scanned_files: return
+        share_to_vanilla[src] = target
+        if target not in base_file_set and target not in new_files_set:
+            new_files.append(target)
+            new_files_set.add(target)
+
     # Any paths not in stage are handled separately since I don't derive from dirs
     # Might change the way I handle this, especially since I derive from dirs later on. Seems redundant
-    for sound_path in sound_paths_for(base_stage):
-        target_sound_path = sound_path.replace(f"se_stage_{base_stage}", f"se_stage_{current_stage}")
-        if sound_path in scanned_files or target_sound_path in scanned_files:
-            continue
-        share_to_vanilla[sound_path] = target_sound_path
-        if target_sound_path not in base_file_set and target_sound_path not in new_files_set:
-            new_files.append(target_sound_path)
-            new_files_set.add(target_sound_path)
-
-    for ui_path in ui_paths_for(base_stage):
-        target_ui_path = ui_path.replace(f"_{base_stage}", f"_{current_stage}")
-        if ui_path in scanned_files or target_ui_path in scanned_files:
-            continue
-        share_to_vanilla[ui_path] = target_ui_path
-        if target_ui_path not in base_file_set and target_ui_path not in new_files_set:
-            new_files.append(target_ui_path)
-            new_files_set.add(target_ui_path)
-
-    eff_path = f"effect/stage/{base_stage}/ef_{base_stage}.eff"
-    target_eff_path = f"effect/stage/{current_stage}/ef_{current_stage}.eff"
-    if eff_path not in scanned_files and target_eff_path not in scanned_files:
-        share_to_vanilla[eff_path] = target_eff_path
-        if target_eff_path not in base_file_set and target_eff_path not in new_files_set:
-            new_files.append(target_eff_path)
-            new_files_set.add(target_eff_path)
+    for sound_path in base_sound_paths:
+        try_share(sound_path, sound_path.replace(f"se_stage_{base_stage}", f"se_stage_{current_stage}"))
+    for ui_path in base_ui_paths:
+        try_share(ui_path, ui_path.replace(f"_{base_stage}", f"_{current_stage}"))
+    try_share(f"effect/stage/{base_stage}/ef_{base_stage}.eff", f"effect/stage/{current_stage}/ef_{current_stage}.eff")
 
     for f in scanned_files:
         if f not in base_file_set and f not in new_files_set:
@@ -326,6 +344,7 @@ def main():
         
 
     new_dir_files, new_dir_infos, new_dir_infos_set = {}, [], set()
+    new_dir_files_sets = {}
 
     base_dir_infos = build_base_dir_infos(dirs_tree, base_stage, current_stage)
     for d in base_dir_infos:
@@ -335,22 +354,21 @@ def main():
 
     sound_key_normal = f"stage/{current_stage}/normal/sound"
     sound_key_battle = f"stage/{current_stage}/battle/sound"
+    sound_prefix = f"sound/bank/stage/se_stage_{current_stage}"
+    sound_prefix_len = len(sound_prefix)
 
     for f in new_files:
-        if is_stage_sound_for(current_stage, f):
-            new_dir_files.setdefault(sound_key_normal, [])
-            new_dir_files.setdefault(sound_key_battle, [])
-            if f not in new_dir_files[sound_key_normal]: new_dir_files[sound_key_normal].append(f)
-            if f not in new_dir_files[sound_key_battle]: new_dir_files[sound_key_battle].append(f)
-            add_dir_with_parents(sound_key_normal, base_file_set, new_dir_infos_set, new_dir_infos)
-            add_dir_with_parents(sound_key_battle, base_file_set, new_dir_infos_set, new_dir_infos)
+        if f.startswith(sound_prefix) and f[sound_prefix_len:] in SOUND_EXTS:
+            add_dir_file(sound_key_normal, f, new_dir_files, new_dir_files_sets)
+            add_dir_file(sound_key_battle, f, new_dir_files, new_dir_files_sets)
+            add_dir_with_parents(sound_key_normal, base_dir_set, new_dir_infos_set, new_dir_infos)
+            add_dir_with_parents(sound_key_battle, base_dir_set, new_dir_infos_set, new_dir_infos)
         else:
-            if "ui/" in f: continue # UI isn't necessary to add it seems
-            parent_dir = str(Path(f).parent).replace("\\", "/")
-            if parent_dir and parent_dir != ".":
-                lst = new_dir_files.setdefault(parent_dir, [])
-                if f not in lst: lst.append(f)
-            add_dir_with_parents(parent_dir, base_file_set, new_dir_infos_set, new_dir_infos)
+            if f.startswith("ui/"): continue # UI isn't necessary to add it seems
+            parent_dir = f[:max(f.rfind("/"), 0)]
+            if parent_dir:
+                add_dir_file(parent_dir, f, new_dir_files, new_dir_files_sets)
+            add_dir_with_parents(parent_dir, base_dir_set, new_dir_infos_set, new_dir_infos)
 
     write_config(root, share_to_vanilla, new_dir_files, new_dir_infos)
     print("Config.json updated")
@@ -374,9 +392,10 @@ def main():
         is_create_database = user_yes_no(f"Json containing stage information detected at {database_json}. Would you like to overwrite this json file?")
         database_path = database_json
     if is_create_database:
+        ui_stage_id = f"ui_stage_{current_stage}"
         database_json = {}
         database_json["stage_database_entries"] = [{   
-        "ui_stage_id": f"ui_stage_{current_stage}",
+        "ui_stage_id": ui_stage_id,
         "clone_from_ui_stage_id": f"ui_stage_{base_stage.replace("battlefield", "battle_field")}",
         "name_id": current_stage,
         "disp_order": 127,
@@ -402,23 +421,22 @@ def main():
         for k, v in stage_mapping.items():
             redir_json[f"{k.replace('normal', '')}{base_stage}"] = [
                 {
-                    "ui_stage_id": f"ui_stage_{current_stage}",
+                    "ui_stage_id": ui_stage_id,
                     "resources": {
                         k.replace("_", ""): {
                             "stage_load_group_hash": f"stage/{current_stage}/{v}",
                             "effect_load_group_hash": f"effect/stage/{current_stage}",
-                            "nus3bank_path_hash": f"sound/bank/stage/se_stage_{current_stage}.nus3bank",
+                            "nus3bank_path_hash": f"{sound_prefix}.nus3bank",
                             "sqb_path_hash": "0x27ad9b4322",
-                            "nus3audio_path_hash": f"sound/bank/stage/se_stage_{current_stage}.nus3audio",
-                            "tonelabel_path_hash": f"sound/bank/stage/se_stage_{current_stage}.tonelabel"
+                            "nus3audio_path_hash": f"{sound_prefix}.nus3audio",
+                            "tonelabel_path_hash": f"{sound_prefix}.tonelabel"
                         }
                     }
                 }
             ]
         database_json["stage_resource_redirection_entries"] = redir_json
         database_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(database_path, "w", encoding="utf-8") as f:
-            json.dump(database_json, f, indent=2)
+        write_json(database_path, database_json)
         print(f"File written to {str(database_path)}")
 
         